@@ -0,0 +1,178 @@
+"""Helpers shared by the extraction scripts: GCP clients, the HTTP retry policy
+and the streaming gzip NDJSON writer.
+
+Each Dockerfile copies this module next to its script.
+"""
+import os, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from google.cloud import storage
+from google.cloud import secretmanager
+
+# Output must stay gzip: the BigQuery external tables in sql/raw read *.json.gz
+# with compression = 'GZIP', which is the only codec BigQuery accepts for NDJSON
+try:
+    # ISA-L SIMD deflate: same API as gzip.compress, several times faster to encode
+    from isal.igzip import compress as gzip_compress
+    GZIP_LEVELS = range(0, 4)
+except ImportError:
+    from gzip import compress as gzip_compress
+    GZIP_LEVELS = range(0, 10)
+
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # resumable upload chunk size for streamed GCS writes
+GZIP_CHUNK_SIZE = 1024 * 1024  # uncompressed bytes per gzip member
+COMPRESS_WORKERS = os.cpu_count() or 1  # threads compressing gzip members in parallel
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "1"))  # favor speed over size (ISA-L accepts 0-3, stdlib zlib 0-9)
+
+# Fail at startup rather than inside a compression worker after pages have been fetched
+if GZIP_LEVEL not in GZIP_LEVELS:
+    raise ValueError(
+        f"GZIP_LEVEL={GZIP_LEVEL} is not supported by {gzip_compress.__module__}; "
+        f"use {GZIP_LEVELS[0]}-{GZIP_LEVELS[-1]}"
+    )
+
+_STORAGE = None
+_SECRET_MANAGER = None
+_TOKEN_LOCK = threading.Lock()
+
+
+def build_retry(backoff_max: int) -> Retry:
+    """429/5xx retry policy for session adapters (with jitter, honoring Retry-After)"""
+    return Retry(
+        total=5,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        backoff_max=backoff_max,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET", "POST"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,  # hand the final response back so raise_for_status() raises HTTPError
+    )
+
+
+class ThreadLocalSessions:
+    """Hand each thread its own keep-alive session (requests.Session is not thread-safe)"""
+
+    def __init__(self, retry: Retry, headers: dict):
+        self._retry = retry
+        self._headers = headers
+        self._local = threading.local()
+
+    def get(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=self._retry))
+            session.headers.update(self._headers)
+            self._local.session = session
+        return session
+
+
+def refresh_token(get_token, stale: str) -> str:
+    """Return a fresh token after a 401 on stale; only the first thread to see the 401 re-reads the secret"""
+    with _TOKEN_LOCK:
+        if get_token() == stale:
+            get_token.cache_clear()
+        return get_token()
+
+
+def storage_client():
+    """Return the process-wide GCS client (auth discovery happens once)"""
+    global _STORAGE
+    if _STORAGE is None:
+        _STORAGE = storage.Client()
+    return _STORAGE
+
+
+def secret_manager_client():
+    """Return the process-wide Secret Manager client"""
+    global _SECRET_MANAGER
+    if _SECRET_MANAGER is None:
+        _SECRET_MANAGER = secretmanager.SecretManagerServiceClient()
+    return _SECRET_MANAGER
+
+
+def upload_success_marker(bkt_name, key):
+    """Write an empty _SUCCESS marker; consumers only check that it exists"""
+    storage_client().bucket(bkt_name).blob(key).upload_from_string(b"", content_type="application/octet-stream")
+
+
+def compress_records(chunk: bytes, compresslevel: int) -> bytes:
+    """Compress each NDJSON line in chunk as its own gzip member"""
+    lines = chunk.split(b"\n")
+    if not lines[-1]:
+        lines.pop()  # the empty segment after a trailing newline; a final record without one is kept
+    return b"".join(gzip_compress(line + b"\n", compresslevel=compresslevel) for line in lines)
+
+
+class GzipBlobWriter:
+    """Stream gzipped NDJSON into a GCS blob; the blob is only opened once there is data to write.
+
+    Output is cut into GZIP_CHUNK_SIZE blocks compressed in parallel (pigz-style)
+    and appended in order as concatenated gzip members, which gzip readers
+    decode as a single stream. With member_per_record, every record in a block
+    becomes its own member, so readers can start decompressing at any record.
+    """
+
+    def __init__(self, bkt_name, key, member_per_record=False):
+        self.bkt_name = bkt_name
+        self.key = key
+        self._compress = compress_records if member_per_record else gzip_compress
+        self._stream = None
+        self._pool = None
+        self._buffer = bytearray()
+        self._pending = deque()
+
+    def write(self, data: bytes):
+        self._buffer += data
+        # Cut large writes into GZIP_CHUNK_SIZE blocks at record boundaries so they compress in parallel
+        while len(self._buffer) >= GZIP_CHUNK_SIZE:
+            size = self._buffer.rfind(b"\n", 0, GZIP_CHUNK_SIZE) + 1
+            if not size:
+                # A single record longer than a block goes out whole
+                size = self._buffer.find(b"\n", GZIP_CHUNK_SIZE) + 1 or len(self._buffer)
+            self._submit_chunk(size)
+
+    def _submit_chunk(self, size=None):
+        if self._stream is None:
+            blob = storage_client().bucket(self.bkt_name).blob(self.key)
+            blob.content_encoding = "gzip"
+            self._stream = blob.open(
+                "wb",
+                chunk_size=UPLOAD_CHUNK_SIZE,
+                content_type="application/x-ndjson",
+                ignore_flush=True,
+            )
+            # Threads suffice: zlib and ISA-L release the GIL while compressing
+            self._pool = ThreadPoolExecutor(max_workers=COMPRESS_WORKERS)
+        if size is None or size >= len(self._buffer):
+            # Hand the whole buffer to the compressor as-is (no copy) and start a fresh one
+            chunk, self._buffer = self._buffer, bytearray()
+        else:
+            chunk = self._buffer[:size]
+            del self._buffer[:size]
+        self._pending.append(self._pool.submit(self._compress, chunk, compresslevel=GZIP_LEVEL))
+
+        # Append finished members in order; block once too many chunks are queued
+        while self._pending and (self._pending[0].done() or len(self._pending) > 2 * COMPRESS_WORKERS):
+            self._stream.write(self._pending.popleft().result())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            # Only finalize on success; an unfinished resumable upload leaves no object behind
+            if exc_type is None:
+                if self._buffer:
+                    self._submit_chunk()
+                while self._pending:
+                    self._stream.write(self._pending.popleft().result())
+                if self._stream is not None:
+                    self._stream.close()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
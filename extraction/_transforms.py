@@ -0,0 +1,71 @@
+"""Record transform for Scope NDJSON output.
+
+Kept in its own module so it can be compiled with mypyc (see setup.py);
+the pure-Python module is used when no compiled extension is present.
+"""
+from typing import Any, Dict, FrozenSet
+
+# Fields holding {dynamic_key: value} maps that BigQuery cannot type
+DYNAMIC_DICT_FIELDS: FrozenSet[str] = frozenset({'roles_users'})
+
+# '?'-suffixed flags renamed to is_<name> rather than <name>
+BOOLEAN_INDICATORS: FrozenSet[str] = frozenset({'archived', 'published', 'active', 'enabled', 'disabled',
+                                                'show_resources', 'published_for_web', 'visible', 'hidden',
+                                                'required', 'optional', 'default'})
+
+
+def _is_clean(obj: Dict[str, Any]) -> bool:
+    """True when a dict has no '?' keys, no dynamic-dict fields and no nested containers"""
+    for key, value in obj.items():
+        if key.endswith('?') or key in DYNAMIC_DICT_FIELDS or isinstance(value, (dict, list)):
+            return False
+    return True
+
+
+def _rename(key: str) -> str:
+    """Strip a trailing '?', turning known boolean flags into is_<name>"""
+    if key.endswith('?'):
+        base_name = key[:-1]
+        return f'is_{base_name}' if base_name in BOOLEAN_INDICATORS else base_name
+    return key
+
+
+def _rename_keys(obj: Any) -> Any:
+    """Rename '?' keys recursively without converting dynamic key dicts"""
+    if isinstance(obj, dict):
+        return {_rename(key): _rename_keys(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [_rename_keys(item) for item in obj]
+    else:
+        return obj
+
+
+def transform(obj: Any) -> Any:
+    """Rename '?' keys and convert dynamic key dicts to arrays in a single recursive pass"""
+    if isinstance(obj, dict):
+        # Most records need no changes; hand those back without rebuilding them
+        if _is_clean(obj):
+            return obj
+
+        new_dict: Dict[str, Any] = {}
+        for key, value in obj.items():
+            new_key = _rename(key)
+            if new_key in DYNAMIC_DICT_FIELDS and isinstance(value, dict):
+                # Convert {"uuid1": "uuid2", "uuid3": "uuid4"}
+                # to [{"key": "uuid1", "value": "uuid2"}, {"key": "uuid3", "value": "uuid4"}]
+                # Entries are only renamed, not converted again, so a dynamic field nested
+                # inside one stays a dict
+                value = [{"key": k, "value": v} for k, v in _rename_keys(value).items()]
+            else:
+                # Recursively process value
+                value = transform(value)
+            new_dict[new_key] = value
+        return new_dict
+
+    elif isinstance(obj, list):
+        if not any(isinstance(item, (dict, list)) for item in obj):
+            return obj
+        return [transform(item) for item in obj]
+
+    else:
+        return obj
@@ -1,8 +1,10 @@
-import os, io, json, gzip, time, datetime as dt
+import functools, datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import requests
-from google.cloud import storage
-from google.cloud import secretmanager
 import google.auth
+from _common import (GzipBlobWriter, ThreadLocalSessions, build_retry, refresh_token, secret_manager_client,
+                     upload_success_marker)
 
 # Configuration
 API_BASE = "https://api.hubapi.com"
@@ -37,93 +39,191 @@ COMPANY_PROPERTIES = [
     "hs_lastmodifieddate",
 ]
 
+# Internal (lowercase) dealstage name for closed won deals
+CLOSED_WON = "closedwon"
 
+# Max IDs per HubSpot batch endpoint call
+BATCH_SIZE = 100
+
+# Batch calls kept in flight at once over the shared connection pool
+BATCH_WORKERS = 4
+
+# HubSpot search returns at most this many results per query; a closedate window over the cap
+# is split into windows expected to hold SEARCH_SHARD_TARGET deals each, searched concurrently
+SEARCH_RESULT_CAP = 10_000
+SEARCH_SHARD_TARGET = 2_500
+SEARCH_WORKERS = 6
+
+# One keep-alive session per thread; 429/5xx retries (with jitter, honoring Retry-After) happen in its adapter
+RETRY = build_retry(backoff_max=60)
+SESSIONS = ThreadLocalSessions(RETRY, {"Accept-Encoding": "gzip"})  # JSON responses compress 5-10x on the wire
+
+
+@functools.lru_cache(maxsize=1)
 def get_hubspot_token():
-    """Return HubSpot API key from Secret Manager"""
+    """Return HubSpot API key from Secret Manager (cached per process)"""
     project = PROJECT_ID
     if not project:
         _, project = google.auth.default()
 
-    client = secretmanager.SecretManagerServiceClient()
+    client = secret_manager_client()
     name = f"projects/{project}/secrets/{SECRET_NAME}/versions/latest"
     resp = client.access_secret_version(request={"name": name})
     return resp.payload.data.decode("utf-8")
 
 
-def request_page(url, headers, params=None, max_retries=5):
-    """GET request with retries for transient errors"""
-    backoff = 1.0
-    for _ in range(max_retries):
-        resp = requests.get(url, headers=headers, params=params, timeout=30)
+def request_page(url, params=None, json_body=None, session=None):
+    """GET (or POST when json_body is given); transient errors are retried by the session's Retry policy"""
+    session = session or SESSIONS.get()
 
-        if resp.status_code == 429:  # Rate limit
-            retry_after = int(resp.headers.get('Retry-After', backoff))
-            time.sleep(retry_after)
-            backoff = min(backoff * 2, 60)
-            continue
-        elif resp.status_code in (500, 502, 503):
-            time.sleep(backoff)
-            backoff = min(backoff * 2, 60)
-            continue
-
-        resp.raise_for_status()
-        return resp.json()
+    def send(token):
+        headers = {"Authorization": f"Bearer {token}"}
+        if json_body is None:
+            return session.get(url, headers=headers, params=params, timeout=30)
+        return session.post(url, headers=headers, params=params, json=json_body, timeout=30)
 
+    # Auth comes from the cached token, so a refreshed token is used by every later request
+    token = get_hubspot_token()
+    resp = send(token)
+    if resp.status_code == 401:
+        # Cached token may have been rotated; fetch a fresh one and retry once
+        resp = send(refresh_token(get_hubspot_token, token))
     resp.raise_for_status()
+    return orjson.loads(resp.content)
 
 
-def upload_gzip_bytes(bkt_name, key, raw_bytes: bytes):
-    """Upload gzipped data to GCS"""
-    client = storage.Client()
-    blob = client.bucket(bkt_name).blob(key)
-    blob.content_type = "application/x-ndjson"
-    blob.content_encoding = "gzip"
-    blob.upload_from_file(io.BytesIO(raw_bytes), rewind=True)
+def post_batches(url, bodies, description):
+    """POST batch request bodies concurrently, yielding responses in order"""
+    def post(body):
+        try:
+            return request_page(url, json_body=body)
+        except requests.HTTPError as e:
+            print(f"Warning: Could not fetch {description} for {len(body['inputs'])} IDs: {e}")
+            return {}
 
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        yield from executor.map(post, bodies)
+
+
+def get_deal_company_associations(deal_ids: list) -> dict:
+    """Map deal IDs to their first associated company ID using the v4 batch associations API"""
+    url = f"{API_BASE}/crm/v4/associations/deals/companies/batch/read"
+    bodies = [
+        {"inputs": [{"id": did} for did in deal_ids[i:i + BATCH_SIZE]]}
+        for i in range(0, len(deal_ids), BATCH_SIZE)
+    ]
+
+    deal_to_company = {}
+    for data in post_batches(url, bodies, "company associations"):
+        for result in data.get("results", []):
+            to = result.get("to") or []
+            if to:
+                deal_to_company[str(result["from"]["id"])] = to[0].get("toObjectId")
+    return deal_to_company
+
+
+def epoch_ms(value: dt.datetime) -> int:
+    """Convert a naive UTC datetime to the epoch milliseconds HubSpot search filters expect"""
+    return int(value.replace(tzinfo=dt.timezone.utc).timestamp() * 1000)
+
+
+def deal_search_body(filters) -> dict:
+    """Request body for one page of a deals search"""
+    return {
+        "filterGroups": [{"filters": filters}],
+        "properties": DEAL_PROPERTIES,
+        "limit": 100,
+    }
+
+
+def search_deals(url, filters, data=None) -> list:
+    """Cursor-paginate one deals search and return all of its results (data: an already-fetched first page)"""
+    body = deal_search_body(filters)
+    deals = []
+
+    while True:
+        # HTTP errors propagate: a partial result set must fail the run rather than be written as complete
+        if data is None:
+            data = request_page(url, json_body=body)
 
-def get_deal_company_association(deal_id: str, headers: dict) -> str:
-    """Get the associated company ID for a deal using v4 associations API"""
-    url = f"{API_BASE}/crm/v4/objects/deals/{deal_id}/associations/companies"
-    try:
-        data = request_page(url, headers)
         results = data.get("results", [])
-        if results:
-            return results[0].get("toObjectId")
-    except Exception as e:
-        pass
-    return None
-
-
-def parse_hubspot_date(date_str: str) -> dt.datetime:
-    """Parse HubSpot date string to datetime (handles both date and datetime formats)"""
-    if not date_str:
-        return None
-    try:
-        # Try full datetime first (e.g., "2023-01-15T12:34:56.789Z")
-        if 'T' in date_str:
-            # Parse and make naive (remove timezone info for comparison)
-            parsed = dt.datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-            return parsed.replace(tzinfo=None)
-        # Fall back to date only (e.g., "2023-01-15")
-        return dt.datetime.strptime(date_str[:10], '%Y-%m-%d')
-    except (ValueError, AttributeError):
-        return None
-
-
-def extract_customer_deals(headers: dict):
-    """Extract all deals, then filter by closedate in last N months AND closed won status"""
+        if not results:
+            break
+        deals.extend(results)
+
+        # Check for next page
+        paging = data.get("paging", {})
+        after = paging.get("next", {}).get("after")
+        if not after:
+            break
+        body["after"] = after
+        data = None
+
+    return deals
+
+
+def closedate_filters(lo: int, hi) -> list:
+    """Closed won filters for the closedate window [lo, hi) in epoch ms; hi=None leaves it open-ended"""
+    filters = [
+        {"propertyName": "dealstage", "operator": "EQ", "value": CLOSED_WON},
+        {"propertyName": "closedate", "operator": "GTE", "value": lo},
+    ]
+    if hi is not None:
+        filters.append({"propertyName": "closedate", "operator": "LT", "value": hi})
+    return filters
+
+
+def search_window(url, lo: int, hi):
+    """Return (total, results) for one closedate window; results is None when total is over the search cap"""
+    filters = closedate_filters(lo, hi)
+    first_page = request_page(url, json_body=deal_search_body(filters))
+    total = first_page.get("total", 0)
+    if total > SEARCH_RESULT_CAP:
+        return total, None
+    return total, search_deals(url, filters, first_page)
+
+
+def split_window(lo: int, hi, total: int, now_ms: int) -> list:
+    """Split [lo, hi) into windows expected to hold SEARCH_SHARD_TARGET deals; the last stays open-ended if hi is"""
+    # An open-ended window is split over [lo, now], or a year past lo when it starts in the future
+    end = hi if hi is not None else max(now_ms, lo + 365 * 24 * 60 * 60 * 1000)
+    if end - lo < 2:
+        raise RuntimeError(f"{total} deals closed within one millisecond at {lo}; cannot shard below the search cap")
+    count = min(end - lo, max(2, -(-total // SEARCH_SHARD_TARGET)))
+    bounds = [lo + (end - lo) * i // count for i in range(count)] + [hi]
+    return list(zip(bounds, bounds[1:]))
+
+
+def search_closed_won(url, cutoff_date: dt.datetime, now: dt.datetime):
+    """Yield result lists covering closed won deals since cutoff_date; split closedate windows only past the search cap"""
+    now_ms = epoch_ms(now)
+
+    # One unsharded search first; any window over the cap is split and searched again until all fit
+    windows = [(epoch_ms(cutoff_date), None)]
+    with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as executor:
+        while windows:
+            oversized = []
+            for (lo, hi), (total, results) in zip(windows, executor.map(lambda w: search_window(url, *w), windows)):
+                if results is None:
+                    oversized.append((lo, hi, total))
+                else:
+                    yield results
+            windows = [w for lo, hi, total in oversized for w in split_window(lo, hi, total, now_ms)]
+            if windows:
+                print(f"{len(oversized)} closedate windows exceed the {SEARCH_RESULT_CAP}-result search cap; "
+                      f"searching {len(windows)} narrower windows")
+
+
+def extract_customer_deals():
+    """Search deals closed won in the last N months (filtered server-side by HubSpot)"""
     print(f"Starting deals extraction (filtering for last {CUSTOMER_LOOKBACK_MONTHS} months, closed won only)...")
 
-    # Calculate cutoff date (naive datetime for comparison)
+    # Calculate cutoff date (naive UTC datetime)
     cutoff_date = dt.datetime.utcnow() - dt.timedelta(days=CUSTOMER_LOOKBACK_MONTHS * 30)
     print(f"Cutoff date: {cutoff_date.strftime('%Y-%m-%d')}")
 
-    url = f"{API_BASE}/crm/v3/objects/deals"
-    params = {
-        "limit": 100,
-        "properties": ",".join(DEAL_PROPERTIES),
-        "archived": "false"
-    }
+    url = f"{API_BASE}/crm/v3/objects/deals/search"
+    cutoff_iso = cutoff_date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
 
     # Output paths
     now = dt.datetime.utcnow()
@@ -131,65 +231,56 @@ def extract_customer_deals(headers: dict):
     part_key = f"{key_prefix}/part-00000.json.gz"
     success_key = f"{key_prefix}/_SUCCESS"
 
-    # NDJSON gzip buffer
-    ndjson_buffer = io.BytesIO()
-    gz = gzip.GzipFile(fileobj=ndjson_buffer, mode="wb")
-
     total_extracted = 0
     total_filtered = 0
     total_no_closedate = 0
     total_too_old = 0
     total_not_won = 0
-    after = None
     customer_company_ids = set()
+    filtered_deals = []
+    seen_deal_ids = set()
 
-    while True:
-        if after:
-            params["after"] = after
-
-        try:
-            data = request_page(url, headers, params)
-        except requests.HTTPError as e:
-            print(f"HTTP error: {e}")
-            break
-
-        results = data.get("results", [])
-        if not results:
-            break
-
+    for results in search_closed_won(url, cutoff_date, now):
         for deal in results:
             deal_id = deal.get("id")
+            # Shards are disjoint, but never write a deal twice
+            if deal_id in seen_deal_ids:
+                continue
+            seen_deal_ids.add(deal_id)
             properties = deal.get("properties", {})
 
             total_extracted += 1
 
+            # Sanity checks on the server-side filters
             # Filter 1: Must have closedate
             closedate_str = properties.get("closedate")
             if not closedate_str:
                 total_no_closedate += 1
                 continue
 
-            closedate = parse_hubspot_date(closedate_str)
-            if not closedate:
-                total_no_closedate += 1
-                continue
-
-            # Filter 2: Must be within date range
-            if closedate < cutoff_date:
+            # Filter 2: Must be within date range (ISO-8601 strings sort chronologically)
+            if closedate_str < cutoff_iso:
                 total_too_old += 1
                 continue
 
-            # Filter 3: Must be "closed won"
-            dealstage = properties.get("dealstage", "").lower()
-            if dealstage != "closedwon":
+            # Filter 3: Must be "closed won" (HubSpot returns internal stage names lowercase)
+            if properties.get("dealstage") != CLOSED_WON:
                 total_not_won += 1
                 continue
 
             # This deal passes all filters!
             total_filtered += 1
+            filtered_deals.append((deal_id, properties))
+
+    # Resolve associated companies in batches rather than one call per deal
+    deal_to_company = get_deal_company_associations([deal_id for deal_id, _ in filtered_deals])
 
-            # Get associated company
-            company_id = get_deal_company_association(deal_id, headers)
+    # Stream NDJSON straight to GCS
+    with GzipBlobWriter(BUCKET, part_key) as gz:
+        dumps, newline = orjson.dumps, orjson.OPT_APPEND_NEWLINE
+        lines = []
+        for deal_id, properties in filtered_deals:
+            company_id = deal_to_company.get(deal_id)
             if company_id:
                 customer_company_ids.add(company_id)
 
@@ -202,20 +293,18 @@ def extract_customer_deals(headers: dict):
                 **properties
             }
 
-            gz.write((json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8"))
+            lines.append(dumps(record, option=newline))
 
-        # Check for next page
-        paging = data.get("paging", {})
-        after = paging.get("next", {}).get("after")
-        if not after:
-            break
+            # Write in batches so the serialized deals are never all held at once
+            if len(lines) >= BATCH_SIZE:
+                gz.write(b"".join(lines))
+                lines.clear()
 
-    gz.close()
+        gz.write(b"".join(lines))
 
     # Upload results
     if total_filtered:
-        upload_gzip_bytes(BUCKET, part_key, ndjson_buffer.getvalue())
-        upload_gzip_bytes(BUCKET, success_key, gzip.compress(b""))
+        upload_success_marker(BUCKET, success_key)
         print(f"✓ Deals: {total_filtered} closed won deals (from {total_extracted} total)")
         print(f"  Filtered out: {total_no_closedate} no date, {total_too_old} too old, {total_not_won} not won")
         print(f"  → gs://{BUCKET}/{part_key}")
@@ -228,7 +317,7 @@ def extract_customer_deals(headers: dict):
     return total_filtered, customer_company_ids
 
 
-def extract_customer_companies(headers: dict, customer_company_ids: set):
+def extract_customer_companies(customer_company_ids: set):
     """Extract only companies associated with filtered deals (all properties)"""
     print(f"Starting companies extraction ({len(customer_company_ids)} customer companies)...")
 
@@ -242,43 +331,44 @@ def extract_customer_companies(headers: dict, customer_company_ids: set):
     part_key = f"{key_prefix}/part-00000.json.gz"
     success_key = f"{key_prefix}/_SUCCESS"
 
-    # NDJSON gzip buffer
-    ndjson_buffer = io.BytesIO()
-    gz = gzip.GzipFile(fileobj=ndjson_buffer, mode="wb")
-
     total = 0
 
-    # Fetch each customer company individually with ALL properties
-    for company_id in customer_company_ids:
-        url = f"{API_BASE}/crm/v3/objects/companies/{company_id}"
-        params = {"properties": ",".join(COMPANY_PROPERTIES)}
-
-        try:
-            resp = requests.get(url, headers=headers, params=params, timeout=30)
-            resp.raise_for_status()
-            data = resp.json()
-            properties = data.get("properties", {})
-
-            # Construct record with metadata
-            record = {
-                "id": company_id,
-                "hubspot_company_url": f"https://app.hubspot.com/contacts/{PORTAL_ID}/record/0-2/{company_id}",
-                **properties
-            }
-
-            gz.write((json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8"))
-            total += 1
-
-        except requests.HTTPError as e:
-            print(f"Warning: Could not fetch company {company_id}: {e}")
-            continue
-
-    gz.close()
+    # Fetch customer companies in batches with ALL properties
+    url = f"{API_BASE}/crm/v3/objects/companies/batch/read"
+    company_ids = list(customer_company_ids)
+    bodies = [
+        {
+            "properties": COMPANY_PROPERTIES,
+            "inputs": [{"id": str(cid)} for cid in company_ids[i:i + BATCH_SIZE]]
+        }
+        for i in range(0, len(company_ids), BATCH_SIZE)
+    ]
+
+    # Batches are fetched concurrently; records are written here, on one thread
+    with GzipBlobWriter(BUCKET, part_key) as gz:
+        dumps, newline = orjson.dumps, orjson.OPT_APPEND_NEWLINE
+        for data in post_batches(url, bodies, "companies"):
+            lines = []
+            for company in data.get("results", []):
+                # Keep the integer ID written as company_id on deal records
+                company_id = int(company["id"])
+                properties = company.get("properties", {})
+
+                # Construct record with metadata
+                record = {
+                    "id": company_id,
+                    "hubspot_company_url": f"https://app.hubspot.com/contacts/{PORTAL_ID}/record/0-2/{company_id}",
+                    **properties
+                }
+
+                lines.append(dumps(record, option=newline))
+                total += 1
+
+            gz.write(b"".join(lines))
 
     # Upload results
     if total:
-        upload_gzip_bytes(BUCKET, part_key, ndjson_buffer.getvalue())
-        upload_gzip_bytes(BUCKET, success_key, gzip.compress(b""))
+        upload_success_marker(BUCKET, success_key)
         print(f"✓ Companies: {total} customer companies (all properties)")
         print(f"  → gs://{BUCKET}/{part_key}")
     else:
@@ -288,15 +378,14 @@ def extract_customer_companies(headers: dict, customer_company_ids: set):
 
 
 def main():
-    # Auth - get Private App token
-    token = get_hubspot_token()
-    headers = {"Authorization": f"Bearer {token}"}
+    # Auth - get Private App token (cached; request_page reads it from the cache)
+    get_hubspot_token()
 
     # Step 1: Extract ALL deals, filter by closedate, collect company IDs
-    total_deals, customer_company_ids = extract_customer_deals(headers)
+    total_deals, customer_company_ids = extract_customer_deals()
 
     # Step 2: Extract only companies associated with filtered deals
-    total_companies = extract_customer_companies(headers, customer_company_ids)
+    total_companies = extract_customer_companies(customer_company_ids)
 
     print(f"\nSummary:")
     print(f"  Deals: {total_deals} (closed in last {CUSTOMER_LOOKBACK_MONTHS} months)")
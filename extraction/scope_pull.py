@@ -1,10 +1,14 @@
-import os, io, json, gzip, time, datetime as dt
+import os, json, functools, datetime as dt
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import orjson
 import requests
-from google.cloud import storage
-from google.cloud import secretmanager
 import google.auth
 from typing import Dict, List, Optional
 from dataclasses import dataclass
+from _common import (GzipBlobWriter, ThreadLocalSessions, build_retry, refresh_token, secret_manager_client,
+                     storage_client, upload_success_marker)
+from _transforms import BOOLEAN_INDICATORS, transform
 
 # Base config - same as original
 API_BASE = os.getenv("API_BASE", "https://api.scope.ws")
@@ -12,6 +16,21 @@ BUCKET = os.getenv("BUCKET", "scope-ws-extract")
 RUN_ID = os.getenv("RUN_ID", dt.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ"))
 SECRET_NAME = os.getenv("SCOPE_API_TOKEN_SECRET", "scope-ws-api-key")
 PROJECT_ID = os.getenv("GCP_PROJECT")
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))  # concurrent endpoints, capped for Scope rate limits
+PAGE_WORKERS = int(os.getenv("PAGE_WORKERS", "4"))  # pages in flight per endpoint
+WATERMARKS_URI = f"gs://{BUCKET}/state/scope/watermarks.json"  # all endpoint watermarks, read and written once per run
+
+# One keep-alive session per thread; 429/5xx retries (with jitter, honoring Retry-After) happen in its adapter
+RETRY = build_retry(backoff_max=30)
+SESSIONS = ThreadLocalSessions(RETRY, {
+    "Accept": "application/json",
+    "Accept-Encoding": "gzip",  # JSON pages compress 5-10x on the wire
+    "Content-Type": "application/json",
+})
+
+# Page requests from every endpoint share one long-lived pool, so worker threads
+# (and the keep-alive session each one holds) persist for the whole run
+PAGE_POOL = ThreadPoolExecutor(max_workers=MAX_WORKERS * PAGE_WORKERS, thread_name_prefix="scope-page")
 
 
 @dataclass
@@ -21,6 +40,9 @@ class EndpointConfig:
     page_size: int = 10  # default page size
     state_key: str = None  # for independent watermarks, defaults to resource
     dependencies: List[str] = None  # endpoints this depends on (for ordering)
+    cursor_field: Optional[str] = None  # response field with the next-page cursor; offset paging when unset
+    filter_key: Optional[str] = None  # request-body key for the watermark; unset pulls a full snapshot
+    member_per_record: bool = False  # one gzip member per record, so readers can split the file (larger output)
 
     def __post_init__(self):
         if self.state_key is None:
@@ -34,23 +56,23 @@ ENDPOINTS = {
     # TIER 1: Core customer and reference data (highest priority)
     "companies": EndpointConfig(
         "companies/search",
-        page_size=25,
+        page_size=100,
         # Companies with hubspot_id are your key customer dimension
     ),
     "task_statuses": EndpointConfig("task-statuses/search", page_size=100),
     "task_types": EndpointConfig("task-types/search", page_size=100),
-    "users": EndpointConfig("users/search", page_size=50),
+    "users": EndpointConfig("users/search", page_size=100),
 
     # TIER 2: Customer relationship and structure data
     "company_users": EndpointConfig(
         "company-users/search",
-        page_size=50,
+        page_size=100,
         dependencies=["companies"]
         # Links HubSpot companies to individual users/contacts
     ),
     "lists": EndpointConfig(
         "lists/search",
-        page_size=25,
+        page_size=100,
         dependencies=["users"]
         # Project/work organization structure
     ),
@@ -58,7 +80,7 @@ ENDPOINTS = {
     # TIER 3: Activity and engagement data (customer health indicators)
     "tasks": EndpointConfig(
         "tasks/search",
-        page_size=20,
+        page_size=100,
         dependencies=["lists", "task_statuses", "task_types", "companies"]
         # Primary activity/engagement data for customer health metrics
     ),
@@ -73,67 +95,23 @@ ENDPOINTS = {
     ),
     "tags": EndpointConfig(
         "tags/search",
-        page_size=50,
+        page_size=100,
         dependencies=["fields"]
         # Tag values for additional customer context
     ),
 }
 
 
-def rename_question_marks_recursive(obj):
-    """Recursively rename all keys with '?' in nested structures"""
-    if isinstance(obj, dict):
-        new_dict = {}
-        for key, value in obj.items():
-            # Rename key if it has '?'
-            if '?' in key and key.endswith('?'):
-                base_name = key[:-1]
-                boolean_indicators = ['archived', 'published', 'active', 'enabled', 'disabled',
-                                      'show_resources', 'published_for_web', 'visible', 'hidden',
-                                      'required', 'optional', 'default']
-                new_key = f'is_{base_name}' if base_name in boolean_indicators else base_name
-            else:
-                new_key = key
-
-            # Recursively process value
-            new_dict[new_key] = rename_question_marks_recursive(value)
-        return new_dict
-
-    elif isinstance(obj, list):
-        return [rename_question_marks_recursive(item) for item in obj]
-
-    else:
-        return obj
-
-
-def normalize_dynamic_dicts(obj, dynamic_dict_fields=['roles_users']):
-    """Convert dynamic key dictionaries to arrays for BigQuery compatibility"""
-    if isinstance(obj, dict):
-        new_dict = {}
-        for key, value in obj.items():
-            if key in dynamic_dict_fields and isinstance(value, dict):
-                # Convert {"uuid1": "uuid2", "uuid3": "uuid4"}
-                # to [{"key": "uuid1", "value": "uuid2"}, {"key": "uuid3", "value": "uuid4"}]
-                new_dict[key] = [{"key": k, "value": v} for k, v in value.items()]
-            else:
-                new_dict[key] = normalize_dynamic_dicts(value, dynamic_dict_fields)
-        return new_dict
-
-    elif isinstance(obj, list):
-        return [normalize_dynamic_dicts(item, dynamic_dict_fields) for item in obj]
-
-    else:
-        return obj
-
+@functools.lru_cache(maxsize=1)
 def get_token():
-    """Return Scope Bearer token. Prefer env override; else read Secret Manager."""
+    """Return Scope Bearer token (cached per process). Prefer env override; else read Secret Manager."""
     token = os.getenv("SCOPE_API_TOKEN")
     if token:
         return token
     project = PROJECT_ID
     if not project:
         _, project = google.auth.default()
-    client = secretmanager.SecretManagerServiceClient()
+    client = secret_manager_client()
     name = f"projects/{project}/secrets/{SECRET_NAME}/versions/latest"
     resp = client.access_secret_version(request={"name": name})
     return resp.payload.data.decode("utf-8")
@@ -148,15 +126,15 @@ def parse_gs_uri(uri: str):
 
 
 def get_state_uri(endpoint_key: str) -> str:
-    """Generate state URI for each endpoint"""
+    """Generate legacy per-endpoint state URI (superseded by WATERMARKS_URI)"""
     return f"gs://{BUCKET}/state/scope/{endpoint_key}.json"
 
 
 def read_state(endpoint_key: str, default_iso: str) -> str:
-    """Read last 'updated_after' watermark for specific endpoint"""
+    """Read last 'updated_after' watermark from a legacy per-endpoint state file"""
     state_uri = get_state_uri(endpoint_key)
     bkt, key = parse_gs_uri(state_uri)
-    client = storage.Client()
+    client = storage_client()
     blob = client.bucket(bkt).blob(key)
     if not blob.exists():
         return default_iso
@@ -164,51 +142,146 @@ def read_state(endpoint_key: str, default_iso: str) -> str:
     return data.get("updated_after", default_iso)
 
 
-def write_state(endpoint_key: str, new_iso: str):
-    """Write watermark for specific endpoint"""
-    state_uri = get_state_uri(endpoint_key)
-    bkt, key = parse_gs_uri(state_uri)
-    client = storage.Client()
-    blob = client.bucket(bkt).blob(key)
-    blob.upload_from_string(
-        json.dumps({"updated_after": new_iso}) + "\n",
+def read_watermarks() -> Dict[str, str]:
+    """Read every endpoint's 'updated_after' watermark in one request"""
+    bkt, key = parse_gs_uri(WATERMARKS_URI)
+    blob = storage_client().bucket(bkt).blob(key)
+    if not blob.exists():
+        return {}
+    return json.loads(blob.download_as_text())
+
+
+def write_watermarks(watermarks: Dict[str, str]):
+    """Write every endpoint's watermark in one request"""
+    bkt, key = parse_gs_uri(WATERMARKS_URI)
+    storage_client().bucket(bkt).blob(key).upload_from_string(
+        json.dumps(watermarks, indent=2, sort_keys=True) + "\n",
         content_type="application/json"
     )
 
 
-def request_page(url, headers, json_body=None, max_retries=5):
-    """POST-only request with retries for transient errors."""
-    backoff = 1.0
-    for _ in range(max_retries):
-        resp = requests.post(
-            url,
-            headers={
-                **headers,
-                "Accept": "application/json",
-                "Content-Type": "application/json",
-            },
-            json=json_body,
-            timeout=30,
-        )
-        if resp.status_code in (429, 500, 502, 503):
-            time.sleep(backoff)
-            backoff = min(backoff * 2, 30)
-            continue
-        resp.raise_for_status()
-        return resp.json()
+def request_page(url, json_body=None, session=None):
+    """POST request; transient errors are retried by the session's Retry policy."""
+    session = session or SESSIONS.get()
+
+    def post(token):
+        return session.post(url, headers={"Authorization": f"Bearer {token}"}, json=json_body, timeout=30)
+
+    # Auth comes from the cached token, so a refreshed token is used by every later request
+    token = get_token()
+    resp = post(token)
+    if resp.status_code == 401:
+        # Cached token may have been rotated; fetch a fresh one and retry once
+        resp = post(refresh_token(get_token, token))
     resp.raise_for_status()
+    return orjson.loads(resp.content)
+
+
+def page_items(data) -> Optional[list]:
+    """Return the records in a page, whichever response wrapper the endpoint uses"""
+    if isinstance(data, dict):
+        return data.get("data") or data.get("items")
+    elif isinstance(data, list):
+        return data
+    return None
+
+
+def iter_cursor_pages(endpoint_key: str, url: str, page_size: int, cursor_field: str, filters: Optional[Dict] = None):
+    """Yield pages by following the cursor each response returns (sequential: each request needs the last cursor)"""
+    cursor = None
+    while True:
+        body = {**(filters or {}), "limit": page_size}
+        if cursor:
+            body["cursor"] = cursor
+        try:
+            data = request_page(url, json_body=body)
+        except requests.HTTPError as e:
+            print(f"HTTP error for {endpoint_key}: {e}")
+            return
+
+        items = page_items(data)
+        if not items:
+            return
 
+        yield items
 
-def upload_gzip_bytes(bkt_name, key, raw_bytes: bytes):
-    client = storage.Client()
-    blob = client.bucket(bkt_name).blob(key)
-    blob.content_type = "application/x-ndjson"
-    blob.content_encoding = "gzip"
-    blob.upload_from_file(io.BytesIO(raw_bytes), rewind=True)
+        cursor = data.get(cursor_field) if isinstance(data, dict) else None
+        if not cursor:
+            return
 
 
-def extract_endpoint(endpoint_key: str, config: EndpointConfig, headers: Dict) -> int:
-    """Extract data for a single endpoint"""
+def iter_pages(endpoint_key: str, url: str, page_size: int, filters: Optional[Dict] = None):
+    """Yield pages in offset order, prefetching up to PAGE_WORKERS pages ahead once a full page arrives.
+
+    A resource may cap limit below page_size, so offsets advance by the size of
+    the first page, and a short first page is confirmed with one more request
+    instead of being taken as the last.
+    """
+    in_flight = deque()
+    next_offset = 0
+    step = page_size
+
+    def prefetch():
+        nonlocal next_offset
+        body = {
+            **(filters or {}),
+            "offset": next_offset,
+            "limit": page_size
+        }
+        in_flight.append(PAGE_POOL.submit(request_page, url, json_body=body))
+        next_offset += step
+
+    prefetch()
+    first_page = True
+
+    try:
+        while in_flight:
+            try:
+                data = in_flight.popleft().result()
+            except requests.HTTPError as e:
+                print(f"HTTP error for {endpoint_key}: {e}")
+                return
+
+            items = page_items(data)
+            if not items:
+                return
+
+            yield items
+
+            if first_page:
+                # Rows per page as the server actually serves them
+                first_page = False
+                step = next_offset = len(items)
+                if step < page_size:
+                    # Either the only page or a capped limit; the next offset tells which
+                    prefetch()
+                    continue
+            elif len(items) < step:
+                return
+
+            # Continue pagination with a window of pages in flight
+            while len(in_flight) < PAGE_WORKERS:
+                prefetch()
+    finally:
+        # Drop speculative requests past the last page
+        for future in in_flight:
+            future.cancel()
+
+
+def log_renamed_fields(endpoint_key: str, rec: Dict):
+    """Show which top-level '?' fields the transform renames, for the first record of an endpoint"""
+    problematic_fields = [k for k in rec if k.endswith('?')]
+    if not problematic_fields:
+        return
+    print(f"✅ FIELD RENAMING ACTIVE for {endpoint_key}")
+    print(f"   Found fields with '?': {problematic_fields}")
+    for field in problematic_fields[:3]:
+        base_name = field[:-1]
+        print(f"   Renaming: {field} → {'is_' + base_name if base_name in BOOLEAN_INDICATORS else base_name}")
+
+
+def extract_endpoint(endpoint_key: str, config: EndpointConfig, watermarks: Dict[str, str]) -> int:
+    """Extract data for a single endpoint, recording its new watermark in watermarks"""
     print(f"=" * 80)
     print(f"âš ï¸  CODE VERSION CHECK: This is the UPDATED code with dynamic field renaming")
     print(f"=" * 80)
@@ -218,7 +291,7 @@ def extract_endpoint(endpoint_key: str, config: EndpointConfig, headers: Dict) -
 
     # Watermark management
     default_since = (dt.datetime.utcnow() - dt.timedelta(days=7)).replace(microsecond=0).isoformat() + "Z"
-    updated_after = read_state(config.state_key, default_since)
+    updated_after = watermarks.get(config.state_key) or read_state(config.state_key, default_since)
 
     # Output paths
     now = dt.datetime.utcnow()
@@ -226,93 +299,44 @@ def extract_endpoint(endpoint_key: str, config: EndpointConfig, headers: Dict) -
     part_key = f"{key_prefix}/part-00000.json.gz"
     success_key = f"{key_prefix}/_SUCCESS"
 
-    # NDJSON gzip buffer
-    ndjson_buffer = io.BytesIO()
-    gz = gzip.GzipFile(fileobj=ndjson_buffer, mode="wb")
-
     total = 0
     max_seen_ts = updated_after
-    offset = 0
 
-    # Pagination loop
-    while True:
-        body = {
-            "offset": offset,
-            "limit": config.page_size
-        }
-
-        try:
-            data = request_page(url, headers, json_body=body)
-        except requests.HTTPError as e:
-            print(f"HTTP error for {endpoint_key}: {e}")
-            break
-
-        # Handle different response wrappers
-        items = None
-        if isinstance(data, dict):
-            items = data.get("data") or data.get("items")
-        elif isinstance(data, list):
-            items = data
-
-        if not items:
-            break
-
-        for rec in items:
-
-            # Rename ALL fields with "?" for BigQuery compatibility
-            problematic_fields = [k for k in list(rec.keys()) if '?' in k]
-
-            # Debug logging - show for first record of each endpoint
-            if problematic_fields and offset == 0 and total == 0:
-                print(f"âœ… FIELD RENAMING ACTIVE for {endpoint_key}")
-                print(f"   Found fields with '?': {problematic_fields}")
-
-            # Rename each problematic field
+    # Stream NDJSON straight to GCS as pages arrive
+    with GzipBlobWriter(BUCKET, part_key, member_per_record=config.member_per_record) as gz:
+        dumps, newline = orjson.dumps, orjson.OPT_APPEND_NEWLINE
+        # Silver reads only the latest run, so endpoints pull full snapshots unless opted in
+        filters = {config.filter_key: updated_after} if config.filter_key else None
+        if config.cursor_field:
+            pages = iter_cursor_pages(endpoint_key, url, config.page_size, config.cursor_field, filters)
+        else:
+            pages = iter_pages(endpoint_key, url, config.page_size, filters)
+        # Pagination loop; pages arrive in order and are written on this thread only
+        for items in pages:
+            # Diagnostics run once, on the first record, outside the per-record loop
+            if not total:
+                log_renamed_fields(endpoint_key, items[0])
+
+            lines = []
             for rec in items:
-                # Get top-level problematic fields for logging
-                problematic_fields = [k for k in list(rec.keys()) if '?' in k]
-
-                # Debug logging - show for first record of each endpoint
-                if problematic_fields and offset == 0 and total == 0:
-                    print(f"✅ FIELD RENAMING ACTIVE for {endpoint_key}")
-                    print(f"   Found fields with '?': {problematic_fields}")
-                    if offset == 0 and total < 3:
-                        for field in problematic_fields[:3]:
-                            print(
-                                f"   Renaming: {field} → {field[:-1] if not field[:-1] in ['archived', 'published', 'active', 'enabled', 'disabled', 'show_resources', 'published_for_web', 'visible', 'hidden', 'required', 'optional', 'default'] else 'is_' + field[:-1]}"
-                                )
-
-                # Recursively rename ALL fields with '?' including nested ones
-                rec = rename_question_marks_recursive(rec)
-
-                # Normalize dynamic key dictionaries for BigQuery
-                rec = normalize_dynamic_dicts(rec)
+                # Rename ALL fields with '?' (including nested ones) and normalize
+                # dynamic key dictionaries for BigQuery, in one pass
+                rec = transform(rec)
 
                 # Track timestamps for watermark
-                ts = rec.get("updated_at") or rec.get("updatedAt") or rec.get("modifiedAt")
-                if ts and ts > max_seen_ts:
+                if (ts := rec.get("updated_at") or rec.get("updatedAt") or rec.get("modifiedAt")) and ts > max_seen_ts:
                     max_seen_ts = ts
 
-                # Track timestamps for watermark
-                ts = rec.get("updated_at") or rec.get("updatedAt") or rec.get("modifiedAt")
-                if ts and ts > max_seen_ts:
-                    max_seen_ts = ts
-
-                gz.write((json.dumps(rec, separators=(",", ":")) + "\n").encode("utf-8"))
+                lines.append(dumps(rec, option=newline))
                 total += 1
 
-        # Continue pagination if we got a full page
-        if len(items) < config.page_size:
-            break
-        offset += config.page_size
-
-    gz.close()
+            # One write per page rather than per record
+            gz.write(b"".join(lines))
 
     # Upload results
     if total:
-        upload_gzip_bytes(BUCKET, part_key, ndjson_buffer.getvalue())
-        upload_gzip_bytes(BUCKET, success_key, gzip.compress(b""))
-        write_state(config.state_key, max_seen_ts)
+        upload_success_marker(BUCKET, success_key)
+        watermarks[config.state_key] = max_seen_ts  # persisted once by main after all endpoints finish
         print(f"âœ“ {endpoint_key}: {total} records â†’ gs://{BUCKET}/{part_key}")
     else:
         print(f"âœ“ {endpoint_key}: No new records")
@@ -320,25 +344,24 @@ def extract_endpoint(endpoint_key: str, config: EndpointConfig, headers: Dict) -
     return total
 
 
-def resolve_dependencies(endpoints: Dict[str, EndpointConfig]) -> List[str]:
-    """Resolve endpoint dependencies into execution order using topological sort"""
-    from collections import defaultdict, deque
-
-    # Build dependency graph
+def build_dependency_graph(endpoints: Dict[str, EndpointConfig]):
+    """Build dependency edges (dependency → endpoint) and in-degree per endpoint"""
     graph = defaultdict(list)
-    in_degree = defaultdict(int)
+    in_degree = {endpoint: 0 for endpoint in endpoints}
 
-    # Initialize all endpoints
-    for endpoint in endpoints.keys():
-        in_degree[endpoint] = 0
-
-    # Build edges (dependency â†’ endpoint)
     for endpoint, config in endpoints.items():
         for dep in config.dependencies:
             if dep in endpoints:  # Only consider configured dependencies
                 graph[dep].append(endpoint)
                 in_degree[endpoint] += 1
 
+    return graph, in_degree
+
+
+def _resolve_dependencies(endpoints: Dict[str, EndpointConfig]) -> List[str]:
+    """Resolve endpoint dependencies into execution order using topological sort"""
+    graph, in_degree = build_dependency_graph(endpoints)
+
     # Topological sort
     queue = deque([ep for ep in endpoints.keys() if in_degree[ep] == 0])
     result = []
@@ -358,37 +381,59 @@ def resolve_dependencies(endpoints: Dict[str, EndpointConfig]) -> List[str]:
     return result
 
 
+# ENDPOINTS is static, so sort once at import; a dependency cycle fails fast here
+EXECUTION_ORDER = _resolve_dependencies(ENDPOINTS)
+
+
+def run_extractions(watermarks: Dict[str, str]):
+    """Extract endpoints concurrently, starting each one as soon as its dependencies finish"""
+    graph, in_degree = build_dependency_graph(ENDPOINTS)
+    total_records = 0
+    successful_endpoints = []
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        def submit(endpoint_keys):
+            return {executor.submit(extract_endpoint, ek, ENDPOINTS[ek], watermarks): ek for ek in endpoint_keys}
+
+        pending = submit(ep for ep in ENDPOINTS if in_degree[ep] == 0)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                endpoint_key = pending.pop(future)
+                try:
+                    total_records += future.result()
+                    successful_endpoints.append(endpoint_key)
+                except Exception as e:
+                    print(f"âœ— {endpoint_key} failed: {e}")
+                    # Continue with other endpoints rather than failing completely
+
+                ready = []
+                for neighbor in graph[endpoint_key]:
+                    in_degree[neighbor] -= 1
+                    if in_degree[neighbor] == 0:
+                        ready.append(neighbor)
+                pending.update(submit(ready))
+
+    return total_records, successful_endpoints
+
+
 def main():
     # Basic validation
     assert BUCKET and "://" not in BUCKET, "BUCKET must be the bucket name only"
     assert API_BASE.startswith("http"), "API_BASE must be a full URL"
 
-    # Auth
-    token = get_token()
-    headers = {"Authorization": f"Bearer {token}"}
+    # Auth: resolve the token before any worker starts, so no thread waits on Secret Manager
+    get_token()
 
-    # Resolve execution order
-    try:
-        execution_order = resolve_dependencies(ENDPOINTS)
-        print(f"Execution order: {' â†’ '.join(execution_order)}")
-    except ValueError as e:
-        print(f"Dependency error: {e}")
-        return
+    print(f"Execution order: {' â†’ '.join(EXECUTION_ORDER)}")
 
-    # Extract each endpoint in dependency order
-    total_records = 0
-    successful_endpoints = []
+    # One state read and one state write per run instead of one of each per endpoint
+    watermarks = read_watermarks()
 
-    for endpoint_key in execution_order:
-        config = ENDPOINTS[endpoint_key]
-        try:
-            records = extract_endpoint(endpoint_key, config, headers)
-            total_records += records
-            successful_endpoints.append(endpoint_key)
-        except Exception as e:
-            print(f"âœ— {endpoint_key} failed: {e}")
-            # Continue with other endpoints rather than failing completely
-            continue
+    # Extract endpoints concurrently; dependencies still finish first
+    total_records, successful_endpoints = run_extractions(watermarks)
+
+    write_watermarks(watermarks)
 
     print(f"\nSummary:")
     print(f"  Total records: {total_records}")
@@ -398,4 +443,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-    main()
\ No newline at end of file
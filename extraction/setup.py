@@ -0,0 +1,17 @@
+"""Compile the Scope record transform with mypyc.
+
+    pip install mypy==1.8.0
+    python setup.py build_ext --inplace
+
+This builds a native _transforms extension next to _transforms.py, which
+Python imports in preference to the .py source. scope_pull.py needs no
+changes either way.
+"""
+from setuptools import setup
+from mypyc.build import mypycify
+
+setup(
+    name="scope-transforms",
+    py_modules=["_transforms"],
+    ext_modules=mypycify(["_transforms.py"]),
+)